@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from .tools import time_derivative
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -11,57 +12,50 @@ def my_heaviside(x, input):
     return y
 
 def component_loss_f(prediction, targets):
-    #Takes the MSE of each component and returns the array of losses
-    loss = torch.zeros(prediction.shape[1])
-    L = nn.MSELoss()
-    for i in range(prediction.shape[1]):
-        loss[i] = L(prediction[:, i], targets[:,i])
-    return loss
+    #Takes the MSE of each component and returns the array of losses.
+    #The result stays on the same device as the inputs.
+    return ((prediction - targets)**2).mean(dim=0)
 
 
 def component_loss_f_L1(prediction, targets):
-    #Takes the MSE of each component and returns the array of losses
-    loss = torch.zeros(prediction.shape[1])
-    L = nn.L1Loss()
-    for i in range(prediction.shape[1]):
-        loss[i] = L(prediction[:, i], targets[:,i])
-    return loss
+    #Takes the L1 loss of each component and returns the array of losses.
+    #The result stays on the same device as the inputs.
+    return torch.abs(prediction - targets).mean(dim=0)
 
 
-def log_loss(prediction, target):
+def log_loss(prediction, target, nnuc: int = 13):
     # Log Loss Function for standard ML.
     # If there are negative values in X we use MSE
     #Enuc stays with MSE because its normalized
 
-    #X is not allowed to be negative. Enuc is
-    X = prediction[:, :13]
-    X_target = target[:, :13]
-    enuc = prediction[:, 13]
-    enuc_target = target[:, 13]
-
-    L = nn.MSELoss()
-
-    enuc_loss = L(enuc, enuc_target)
-
+    #log of small mass fractions underflows in float16 so under autocast
+    #this loss is still evaluated in float32.
+    prediction = prediction.float()
+    target = target.float()
 
-    #if there are negative numbers we cant use log on massfractions
-    if torch.sum(X < 0) > 0:
-        #how much do we hate negative numbers?
-        factor = 1000 # a lot
-        return enuc_loss + factor*L(X, X_target)
-
-    else:
-        barrier = torch.tensor([.1], device=device)
-        value = torch.tensor([0.], device=device)
+    #X is not allowed to be negative. Enuc is
+    X = prediction[:, :nnuc]
+    X_target = target[:, :nnuc]
 
-        #greater than barrier we apply mse loss
-        #less then barier we apply log of mse loss
-        A = my_heaviside(target - barrier, value)
-        B = -my_heaviside(target - barrier, value) + 1
+    enuc_loss = torch.mean((prediction[:, nnuc] - target[:, nnuc])**2)
+    X_mse = torch.mean((X - X_target)**2)
 
+    #if there are negative numbers we cant use log on massfractions.
+    #This is a torch.where rather than an if, so it doesn't sync with the gpu
+    #and the function can be compiled with TorchScript (see pinn_criterion).
+    negative = (X < 0).any()
+    #keeps the unused log branch finite so it can't put nans in the gradient
+    X_log = torch.where(negative, torch.ones_like(X), X)
+    X_log_mse = torch.mean((torch.log(X_log) - torch.log(X_target))**2)
 
-        X_loss =  torch.sum(A * L(X, X_target) + B* torch.abs(.01*L(torch.log(X), torch.log(X_target))))
+    #greater than barrier (.1) we apply mse loss
+    #less then barier we apply log of mse loss
+    above = (target > .1).sum()
+    below = target.numel() - above
 
+    #how much do we hate negative numbers? a lot
+    X_loss = torch.where(negative, 1000*X_mse,
+                         above*X_mse + below*torch.abs(.01*X_log_mse))
 
     return enuc_loss + X_loss
 
@@ -96,15 +90,9 @@ def loss_pinn(input, prediction, target, enuc_fac, enuc_dot_fac,
 
     #rhs_t_1 = target[:, 15:28]
 
-    dpndx = torch.zeros_like(prediction)
-    for n in range(nnuc+1):
-        if input.grad is not None:
-            #sets componnents to zero if not already zero
-            input.grad.data.zero_()
-
-        prediction[:, n].backward(torch.ones_like(prediction[:,n]), retain_graph=True)
-        dpndx[:, n] = input.grad.clone()[:, 0]
-        input.grad.data.zero_()
+    #autograd.grad doesn't accumulate into input.grad, so there is nothing to
+    #zero or clone. The graph is kept so this loss trains the network.
+    dpndx = time_derivative(prediction, input, create_graph=True)
 
 
 
@@ -112,7 +100,8 @@ def loss_pinn(input, prediction, target, enuc_fac, enuc_dot_fac,
     # for i in range(dpndx.shape[0]):
     #     dpndx[i, 0:nnuc] = dpndx[i, 0:nnuc]/rate_factors
     #both enuc and enucdot were scaled so we have to apply both factors
-    dpndx[:, nnuc] = dpndx[:, nnuc] * enuc_fac/enuc_dot_fac
+    dpndx = torch.cat((dpndx[:, :nnuc], dpndx[:, nnuc:nnuc+1] * enuc_fac/enuc_dot_fac,
+                       dpndx[:, nnuc+1:]), dim=1)
     #dpndx = dpndx/rate_factors
     #dpndx[enuc_dot] = dpndx[enuc_dot] * enuc_fac/enuc_dot_fac
 
@@ -180,8 +169,9 @@ def loss_pinn(input, prediction, target, enuc_fac, enuc_dot_fac,
 
         return loss
 
-def loss_mass_fraction(prediction, nnuc=13):
-    return 10* torch.abs(1 - torch.sum(prediction[:, :nnuc]))
+def loss_mass_fraction(prediction, nnuc: int = 13):
+    #per sample, so neither the loss nor its gradient grows with the batch size
+    return 10*torch.abs(1 - prediction[:, :nnuc].sum(dim=1)).mean()
 
 
 def loss_pure(prediction, target, log_option = False):
@@ -229,7 +219,9 @@ def derivative_loss_piecewise(dxdt, actual, enuc_fac, enuc_dot_fac, nnuc=13):
     scaling = torch.tensor([.01])
 
 
-    dxdt[:, nnuc] = dxdt[:, nnuc] * enuc_fac/enuc_dot_fac
+    #out of place, dxdt is part of the autograd graph
+    dxdt = torch.cat((dxdt[:, :nnuc], dxdt[:, nnuc:nnuc+1] * enuc_fac/enuc_dot_fac,
+                      dxdt[:, nnuc+1:]), dim=1)
 
     scaled_dxdt = scaling_func(torch.abs(dxdt), lambda x : x, b1, b2, scaling)
     scaled_actual = scaling_func(torch.abs(actual), lambda x : x, b1, b2, scaling)
@@ -239,12 +231,16 @@ def derivative_loss_piecewise(dxdt, actual, enuc_fac, enuc_dot_fac, nnuc=13):
     return F(scaled_dxdt, scaled_actual)
 
 def signed_loss_function(pred, actual):
-    F = nn.L1Loss()
-    return F(torch.sign(pred), torch.sign(actual))
+    #L1 loss of the signs, written out so it can be compiled with TorchScript
+    return torch.mean(torch.abs(torch.sign(pred) - torch.sign(actual)))
 
 
 def relative_loss(prediction, target):
 
+    #the 1.e-15 threshold is not representable in float16, keep this in float32
+    #when training under autocast.
+    prediction = prediction.float()
+    target = target.float()
 
     threshold = target.clone()
     threshold[target<1.e-15] = 1.e-15
@@ -256,3 +252,39 @@ def relative_loss(prediction, target):
         return torch.tensor([1.0])
     else:
         return torch.mean(torch.abs(prediction-target)/threshold)
+
+
+def _pinn_criterion(input, prediction, dXdt, target, nnuc: int = 13):
+    prediction = prediction.float()
+    dXdt = dXdt.float()
+    target = target.float()
+
+    rates = target[:, nnuc+1:]
+
+    # -- difference in state variables vs prediction
+    loss1 = log_loss(prediction[:, :nnuc+1], target[:, :nnuc+1], nnuc)
+
+    # -- rates (pinn part)
+    loss2 = torch.mean(torch.abs(dXdt - rates))
+
+    # -- sign of the rates
+    loss3 = signed_loss_function(dXdt, rates)
+
+    # -- mass fractions sum to 1
+    loss5 = loss_mass_fraction(prediction, nnuc)
+
+    return loss1 + loss2 + loss3 + loss5, torch.stack([loss1, loss2, loss3, loss5]).detach()
+
+_pinn_criterion_scripted = None
+
+def pinn_criterion(input, prediction, dXdt, target, nnuc=13):
+    # The criterion from the getting started example (log_loss, L1 on the
+    # rates, signed_loss_function and loss_mass_fraction) compiled as one
+    # TorchScript function, so the fuser can merge the pointwise ops into a
+    # few kernels. Matches the train(model, optimizer, num_epochs, criterion)
+    # interface of the pinn. It is scripted on first use rather than at
+    # import, so a TorchScript problem can't break importing this module.
+    global _pinn_criterion_scripted
+    if _pinn_criterion_scripted is None:
+        _pinn_criterion_scripted = torch.jit.script(_pinn_criterion)
+    return _pinn_criterion_scripted(input, prediction, dXdt, target, nnuc)
@@ -175,7 +175,7 @@ class plotting_pinn:
     def __init__(self, model, fields, test_loader, cost_per_epoc,
                 component_losses_test, component_losses_train,
                 d_component_losses_test, d_component_losses_train,
-                cost_per_epoc_test, different_loss_metrics, output_dir):
+                cost_per_epoc_test, different_loss_metrics, output_dir, test_epochs=None):
 
         self.model = model
         self.fields = fields
@@ -190,6 +190,12 @@ class plotting_pinn:
         self.cost_per_epoc_test = cost_per_epoc_test
         self.different_loss_metrics = different_loss_metrics
         self.output_dir = output_dir
+        #test data may only be evaluated every few epochs, these are the
+        #(1 based) epochs its losses belong to.
+        if test_epochs is None:
+            self.test_epocs = np.linspace(1, len(cost_per_epoc_test), num=len(cost_per_epoc_test))
+        else:
+            self.test_epocs = np.array(test_epochs) + 1
 
         isdir = os.path.isdir(output_dir)
         if not isdir:
@@ -218,7 +224,11 @@ class plotting_pinn:
                     targets_whole = torch.cat((targets_whole, targets))
 
             #for batch_idx, (data, targets) in enumerate(self.test_loader):
-            pred = self.model(data_whole)
+            #the loader may hand out batches on the gpu, evaluate wherever the
+            #model is and plot on the cpu.
+            model_device = next(self.model.parameters()).device
+            pred = self.model(data_whole.to(model_device)).cpu()
+            targets_whole = targets_whole.cpu()
 
             for i in range(self.nnuc+1):
                 plt.scatter(pred[:, i], targets_whole[:, i], color=colors[i], label=self.fields[i])
@@ -245,10 +255,10 @@ class plotting_pinn:
         epocs = np.linspace(1, len(self.cost_per_epoc), num=len(self.cost_per_epoc))
 
         axs[0].plot(epocs, self.cost_per_epoc, label='Training Data')
-        axs[0].plot(epocs, self.cost_per_epoc_test, label='Testing Data')
+        axs[0].plot(self.test_epocs, self.cost_per_epoc_test, label='Testing Data')
 
         axs[1].semilogy(epocs, self.cost_per_epoc)
-        axs[1].semilogy(epocs, self.cost_per_epoc_test)
+        axs[1].semilogy(self.test_epocs, self.cost_per_epoc_test)
 
         fig.suptitle('Overall cost of training data')
         axs[1].set_xlabel("Num Epochs")
@@ -295,13 +305,12 @@ class plotting_pinn:
         gs = fig.add_gridspec(2,1, hspace=0)
         axs = gs.subplots(sharex=True)
 
-        N = self.component_losses_test.shape[0]
         for i in range(self.nnuc+1):
-            axs[0].plot(np.linspace(1, N, num=N), self.component_losses_test[:, i],
+            axs[0].plot(self.test_epocs, self.component_losses_test[:, i],
                         label=self.fields[i])
 
         for i in range(self.nnuc+1):
-            axs[1].semilogy(np.linspace(1, N, num=N), self.component_losses_test[:, i],
+            axs[1].semilogy(self.test_epocs, self.component_losses_test[:, i],
                             label=self.fields[i])
 
         fig.suptitle('Component wise error in testing data')
@@ -348,13 +357,12 @@ class plotting_pinn:
         gs = fig.add_gridspec(2,1, hspace=0)
         axs = gs.subplots(sharex=True)
 
-        N = self.d_component_losses_test.shape[0]
         for i in range(self.nnuc+1):
-            axs[0].plot(np.linspace(1, N, num=N), self.d_component_losses_test[:, i],
+            axs[0].plot(self.test_epocs, self.d_component_losses_test[:, i],
                         label=self.fields[i])
 
         for i in range(self.nnuc+1):
-            axs[1].semilogy(np.linspace(1, N, num=N), self.d_component_losses_test[:, i],
+            axs[1].semilogy(self.test_epocs, self.d_component_losses_test[:, i],
                             label=self.fields[i])
 
         fig.suptitle('Derivative component wise error in testing data')
@@ -374,13 +382,12 @@ class plotting_pinn:
         gs = fig.add_gridspec(2,1, hspace=0)
         axs = gs.subplots(sharex=True)
 
-        N = self.component_losses_test.shape[0]
         for i in range(self.nnuc+1, (self.nnuc+1)*2):
-            axs[0].plot(np.linspace(1, N, num=N), self.component_losses_test[:, i],
+            axs[0].plot(self.test_epocs, self.component_losses_test[:, i],
                         label=self.fields[i])
 
         for i in range(self.nnuc+1, (self.nnuc+1)*2):
-            axs[1].semilogy(np.linspace(1, N, num=N), self.component_losses_test[:, i],
+            axs[1].semilogy(self.test_epocs, self.component_losses_test[:, i],
                             label=self.fields[i])
 
         fig.suptitle('Component wise error in testing data')
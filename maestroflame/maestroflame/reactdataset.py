@@ -34,9 +34,9 @@ class ReactDataset(Dataset):
         self.output_files = self.get_files(data_path, output_prefix)
 
         print("Loading Input Files...")
-        self.input_data, self.input_break_file  = self.load_files(self.input_files, inputs=True)
+        self.input_data, self.input_break_file, self.input_fields = self.load_files(self.input_files, inputs=True)
         print("Loading Output Files...")
-        self.output_data, self.output_break_file = self.load_files(self.output_files)
+        self.output_data, self.output_break_file, self.fields = self.load_files(self.output_files)
 
         #we want them to be the same length - so cut off data if we need to
 
@@ -76,6 +76,8 @@ class ReactDataset(Dataset):
     def load_files(self, file_list, inputs=False):
 
         break_file = None
+        #field names, kept from the first plotfile so nobody has to reload it
+        fields = None
 
         #Store data each row corresponds to data acros the grid of a different field.
         for j, file in enumerate(file_list):
@@ -83,6 +85,8 @@ class ReactDataset(Dataset):
             try:
                 ds = yt.load(file)
                 dt = ds.current_time.to_value()
+                if fields is None:
+                    fields = list(ds._field_list)
                 #Store data each row corresponds to data acros the grid of a different field.
                 if self.do_flame_cut:
                     flame_loc = self.get_flame_loc(file)
@@ -151,7 +155,7 @@ class ReactDataset(Dataset):
                     break_file = file
                     break
 
-        return data_set, break_file
+        return data_set, break_file, fields
 
 
     def __getitem__(self, index):
@@ -182,6 +186,15 @@ class ReactDataset(Dataset):
         return self.input_data.shape[2]* self.input_data.shape[0]
 
 
+    def samples(self, device='cpu', dtype=torch.float):
+        #All samples in a component major [fields, N] layout, so every field is
+        #one contiguous row. Columns are in the same order as __getitem__
+        #indexes them.
+        X = self.input_data.permute(1, 0, 2).reshape(self.input_data.shape[1], -1)
+        Y = self.output_data.permute(1, 0, 2).reshape(self.output_data.shape[1], -1)
+        return X.to(device=device, dtype=dtype), Y.to(device=device, dtype=dtype)
+
+
     def cut_data_set(self,N):
         #We have about 8gb of data and i can't train with that much when we're just testing.
         self.input_data = self.input_data[1:N,:,:]
@@ -243,3 +256,31 @@ class ReactDataset(Dataset):
             flame_slice = ds.r[:, flame_loc-2*half:flame_loc+half]
 
         return flame_loc
+
+
+class DeviceBatchLoader:
+    #Stands in for a DataLoader when the samples already live on the training
+    #device. Each epoch shuffles the subset given by indices and gathers the
+    #batches on the device, so there is no per sample collation and no host to
+    #device copy. The data is sample major ([N, fields]) so each batch is
+    #gathered as contiguous rows.
+
+    def __init__(self, input_data, output_data, indices, batch_size=16, shuffle=True):
+        self.input_data = input_data
+        self.output_data = output_data
+        self.indices = indices
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        if self.shuffle:
+            order = self.indices[torch.randperm(len(self.indices), device=self.indices.device)]
+        else:
+            order = self.indices
+
+        for i in range(0, len(order), self.batch_size):
+            idx = order[i:i+self.batch_size]
+            yield self.input_data[idx], self.output_data[idx]
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
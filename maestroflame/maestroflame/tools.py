@@ -1,22 +1,65 @@
+import os
 import sys
+import inspect
 import torch
+import torch.optim as optim
 
 class Logger(object):
-    def __init__(self, log_file):
+    def __init__(self, log_file, enabled=True):
+        #enabled=False makes every write a no-op, e.g. on non zero ranks
         self.log_file = log_file
+        self.enabled = enabled
         self.terminal = sys.stdout
-        self.log = open(log_file, "a")
+        if not self.enabled:
+            return
+        #kept open and block buffered rather than reopened for every message,
+        #call flush() to push everything to disk.
+        self.log = open(log_file, "a", buffering=8192)
         self.log.write("MaestroFlame\n")
-        self.log.close()
 
     def write(self, message):
+        if not self.enabled:
+            return
         self.terminal.write(message + '\n')
-        self.log = open(self.log_file, "a")
-        self.log.write(message)
-        self.log.close()
+        self.log.write(message + '\n')
 
     def flush(self):
-        pass
+        if not self.enabled:
+            return
+        self.terminal.flush()
+        self.log.flush()
+
+def save_model(model, file_name):
+    #Writes to a temporary file and renames it into place, so an interrupted
+    #save never leaves a truncated model behind.
+    tmp_name = file_name + '.tmp'
+    torch.save(model.state_dict(), tmp_name)
+    os.replace(tmp_name, file_name)
+
+def time_derivative(prediction, input, create_graph=False):
+    #Derivative of every output component with respect to dt (input[:, 0]).
+    #Samples in a batch are independent so d(sum_b pred[b, n])/d input[b, 0] is
+    #the per sample derivative. Rather than one backward pass per output
+    #component, we take a vector jacobian product with a dummy cotangent v and
+    #differentiate its dt column with respect to v. This is two graph walks no
+    #matter how many outputs the network has.
+    v = torch.ones_like(prediction, requires_grad=True)
+    vjp = torch.autograd.grad(prediction, input, v, create_graph=True)[0]
+    return torch.autograd.grad(vjp[:, 0], v, torch.ones_like(vjp[:, 0]),
+                               create_graph=create_graph)[0]
+
+def fused_adam(params, lr):
+    #Adam that updates every parameter in as few kernels as possible. The fused
+    #cuda kernel needs torch >= 1.13 and all parameters on the gpu, otherwise
+    #fall back to the multi tensor (foreach) implementation if there is one.
+    params = list(params)
+    adam_args = inspect.signature(optim.Adam).parameters
+    if 'fused' in adam_args and all(p.is_cuda for p in params):
+        return optim.Adam(params, lr=lr, fused=True)
+    elif 'foreach' in adam_args:
+        return optim.Adam(params, lr=lr, foreach=True)
+    else:
+        return optim.Adam(params, lr=lr)
 
 def scaling_func(x, f, barrier1, barrier2, scaling, smallest_num=torch.tensor([1e-30])):
 
@@ -19,8 +19,9 @@ import torch.optim as optim
 import torch.utils.data
 from torch.utils.data.dataset import Dataset
 from torch.utils.data import DataLoader
-from .reactdataset import ReactDataset
+from .reactdataset import ReactDataset, DeviceBatchLoader
 from .losses import component_loss_f, component_loss_f_L1
+from .tools import time_derivative, fused_adam, save_model
 from .plotting import plotting_standard, plotting_pinn
 
 
@@ -117,19 +118,20 @@ class NuclearReactionML:
 
                 react_data = ReactDataset(data_path, input_prefix, output_prefix, plotfile_prefix, DEBUG_MODE=DEBUG_MODE)
 
-                #Normalize density, temperature, and enuc
-                dens_fac = torch.max(react_data.input_data[:, 14, :])
-                temp_fac = torch.max(react_data.input_data[:, 15, :])
+                #Normalize density, temperature, and enuc. Density and temperature
+                #are neighbouring channels so they share one reduction, then the
+                #data is scaled in place by the reciprocal of the factors.
+                in_facs = react_data.input_data[:, 14:16, :].amax(dim=(0, 2), keepdim=True)
+                dens_fac, temp_fac = in_facs.flatten()
                 enuc_fac = torch.max(react_data.output_data[:, 13, :])
-                react_data.input_data[:, 14, :]  = react_data.input_data[:, 14, :]/dens_fac
-                react_data.input_data[:, 15, :]  = react_data.input_data[:, 15, :]/temp_fac
-                react_data.output_data[:, 13, :] = react_data.output_data[:, 13, :]/enuc_fac
+                react_data.input_data[:, 14:16, :].mul_(in_facs.reciprocal())
+                react_data.output_data[:, 13, :].mul_(1/enuc_fac)
 
                 #save these factors to a file
                 arr = np.array([dens_fac.item(), temp_fac.item(), enuc_fac.item()])
                 np.savetxt(self.output_dir + 'scaling_factors.txt', arr, header='Density, Temperature, Enuc factors (ordered)')
 
-                self.fields = [field for field in yt.load(react_data.output_files[0])._field_list]
+                self.fields = react_data.fields
 
 
                 #percent cut for testing
@@ -141,8 +143,12 @@ class NuclearReactionML:
 
                 train_set, test_set = torch.utils.data.random_split(react_data, [Num_train, Num_test])
 
-                self.train_loader = DataLoader(dataset=train_set, batch_size=16, shuffle=True)
-                self.test_loader = DataLoader(dataset=test_set, batch_size=16, shuffle=True)
+                #pinned host memory lets the copy to the gpu run asynchronously
+                #while the previous batch is still being computed. No worker
+                #processes, the data is in memory and a sample is just an index.
+                loader_kwargs = dict(batch_size=16, shuffle=True, pin_memory=(device.type == 'cuda'))
+                self.train_loader = DataLoader(dataset=train_set, **loader_kwargs)
+                self.test_loader = DataLoader(dataset=test_set, **loader_kwargs)
 
 
     def hyperparamter_optimization(self):
@@ -182,7 +188,7 @@ class NuclearReactionML:
             optimizer = hyper_results['optimizer']
             lr = hyper_results['lr']
             if optimizer == 'Adam':
-                optimizer = optim.Adam(model.parameters(), lr=lr)
+                optimizer = fused_adam(model.parameters(), lr=lr)
             elif optimizer == 'RMSprop':
                 optimizer = optim.RMSprop(model.parameters(), lr=lr)
             elif optimizer == 'SGD':
@@ -217,8 +223,8 @@ class NuclearReactionML:
 
                 for batch_idx, (data, targets) in enumerate(self.train_loader):
                     # Get data to cuda if possible
-                    data = data.to(device=device)
-                    targets = targets.to(device=device)
+                    data = data.to(device=device, non_blocking=True)
+                    targets = targets.to(device=device, non_blocking=True)
 
                     # forward
                     pred = model(data)
@@ -239,7 +245,7 @@ class NuclearReactionML:
                                 component_loss = component_loss + loss_c
 
                     # backward
-                    optimizer.zero_grad()
+                    optimizer.zero_grad(set_to_none=True)
                     loss.backward()
 
                     # gradient descent or adam step
@@ -247,6 +253,8 @@ class NuclearReactionML:
 
 
                 self.logger.write(f"Cost at epoch {epoch} is {sum(losses) / len(losses)}")
+                #so an interrupted run still has its log
+                self.logger.flush()
                 self.component_losses_train.append(component_loss/batch_idx)
                 self.cost_per_epoc.append(sum(plotting_losses) / len(plotting_losses))
 
@@ -259,8 +267,8 @@ class NuclearReactionML:
                         #Evaulate NN on testing data.
                         for batch_idx, (data, targets) in enumerate(self.test_loader):
                             # Get data to cuda if possible
-                            data = data.to(device=device)
-                            targets = targets.to(device=device)
+                            data = data.to(device=device, non_blocking=True)
+                            targets = targets.to(device=device, non_blocking=True)
 
                             # forward
                             pred = model(data)
@@ -286,10 +294,11 @@ class NuclearReactionML:
                         os.mkdir(directory)
 
 
-                        torch.save(model.state_dict(), directory+'my_model.pt')
-                        np.savetxt(directory + "/cost_per_epoch.txt", self.cost_per_epoc)
-                        np.savetxt(directory + "/component_losses_test.txt", self.component_losses_test)
-                        np.savetxt(directory + "/component_losses_train.txt", self.component_losses_train)
+                        #binary .npy checkpoints, text is only written once at the end
+                        save_model(model, directory+'my_model.pt')
+                        np.save(directory + "/cost_per_epoch.npy", self.cost_per_epoc)
+                        np.save(directory + "/component_losses_test.npy", self.component_losses_test)
+                        np.save(directory + "/component_losses_train.npy", self.component_losses_train)
 
 
                         plot_class = plotting_standard(model, self.fields, self.test_loader, self.cost_per_epoc, np.array(self.component_losses_test),
@@ -307,12 +316,7 @@ class NuclearReactionML:
 
             if self.SAVE_MODEL:
                 self.logger.write("Saving...")
-                file_name = self.output_dir + 'my_model.pt'
-                if os.path.exists(file_name):
-                    self.logger.write("Overwritting file:", file_name)
-                    os.rename(file_name, file_name+'.backup')
-
-                torch.save(model.state_dict(), file_name)
+                save_model(model, self.output_dir + 'my_model.pt')
                 np.savetxt(self.output_dir + "/cost_per_epoch.txt", self.cost_per_epoc)
                 np.savetxt(self.output_dir + "/component_losses_test.txt", self.component_losses_test)
                 np.savetxt(self.output_dir + "/component_losses_train.txt", self.component_losses_train)
@@ -336,7 +340,8 @@ class NuclearReactionPinn:
 
     def __init__(self, data_path, input_prefix, output_prefix, plotfile_prefix,
                 output_dir, log_file, DEBUG_MODE=False, DO_PLOTTING=True,
-                SAVE_MODEL=True, DO_HYPER_OPTIMIZATION=False, DO_GRADIENT_PLOT=False):
+                SAVE_MODEL=True, DO_HYPER_OPTIMIZATION=False, DO_GRADIENT_PLOT=False,
+                USE_AMP=False, COMPILE_MODEL=False, batch_size=1024):
                 """
                 data_path (string): this is the path to your data files
 
@@ -382,14 +387,59 @@ class NuclearReactionPinn:
                                          This is a different option then DO_PLOTTING
                                          because it takes quite a long time and
                                          is more for debugging. Default=False
-                """
 
+                USE_AMP (bool): Train with automatic mixed precision. Only has
+                                an effect on a cuda device, where it makes use
+                                of tensor cores. Uses bfloat16 on gpus with
+                                bfloat16 tensor cores (Ampere and newer,
+                                compute capability 8.0+), which needs no
+                                loss scaling, otherwise float16 with loss
+                                scaling. Default=False
+
+                COMPILE_MODEL (bool): Compile the model with TorchScript before
+                                      training so its elementwise activations
+                                      are fused with the surrounding ops. The
+                                      network must be scriptable (Net and
+                                      Deep_Net are). Default=False
+
+                batch_size (int): Number of samples per training batch. The
+                                  networks are small, so large batches are
+                                  needed to keep the gpu busy. If you change
+                                  this, scale the learning rate of your
+                                  optimizer along with it. Default=1024
+
+                Multiple gpus: launch your script with
+                torchrun --nproc_per_node=N and training runs with
+                DistributedDataParallel, one process per gpu. Each process
+                trains on its own shard of the training data with batches of
+                batch_size, so the effective batch size is N*batch_size; scale
+                the learning rate accordingly. Only rank 0 logs, plots and
+                saves output.
+                """
 
+                #torchrun sets these, a plain python launch is a single process.
+                self.world_size = int(os.environ.get('WORLD_SIZE', 1))
+                self.distributed = self.world_size > 1
+                if self.distributed:
+                    self.rank = int(os.environ['RANK'])
+                    self.local_rank = int(os.environ['LOCAL_RANK'])
+                    #device is "cuda" without an index, so this picks our gpu
+                    torch.cuda.set_device(self.local_rank)
+                    torch.distributed.init_process_group(backend='nccl')
+                else:
+                    self.rank = 0
 
-                self.DO_PLOTTING = DO_PLOTTING
+                self.DO_PLOTTING = DO_PLOTTING and self.rank == 0
                 self.output_dir = output_dir
-                self.DO_GRADIENT_PLOT = DO_GRADIENT_PLOT
-                self.SAVE_MODEL = SAVE_MODEL
+                self.DO_GRADIENT_PLOT = DO_GRADIENT_PLOT and self.rank == 0
+                self.USE_AMP = USE_AMP and device.type == 'cuda'
+                #bfloat16 has the range of float32 so it can skip the GradScaler.
+                #Only Ampere (compute capability 8.0) and newer have bfloat16
+                #tensor cores. torch.cuda.is_bf16_supported can't be used, it is
+                #also true on older gpus that merely emulate bfloat16 (slowly).
+                self.USE_BF16 = self.USE_AMP and torch.cuda.get_device_capability()[0] >= 8
+                self.COMPILE_MODEL = COMPILE_MODEL
+                self.SAVE_MODEL = SAVE_MODEL and self.rank == 0
                 self.DO_HYPER_OPTIMIZATION = DO_HYPER_OPTIMIZATION
 
 
@@ -397,18 +447,34 @@ class NuclearReactionPinn:
                     print("Hyperparameter optimization is not yet supported for pinns.")
                     sys.exit()
 
-                if os.path.isdir(output_dir) and (len(os.listdir(output_dir)) != 0):
+                #Only rank 0 looks at output_dir, ranks on other nodes may not
+                #share its filesystem. Its decision is broadcast so every rank
+                #stops together instead of waiting on a rank 0 that exited.
+                abort = False
+                if self.rank == 0 and os.path.isdir(output_dir) and (len(os.listdir(output_dir)) != 0):
                     print(f"Directory {output_dir} exists and is not empty.")
                     print("Please change output_dir or remove the directory to prevent overwritting data.")
+                    abort = True
+
+                if self.distributed:
+                    abort_flag = torch.tensor([int(abort)], device=device)
+                    torch.distributed.broadcast(abort_flag, 0)
+                    abort = bool(abort_flag.item())
+
+                if abort:
+                    if self.distributed:
+                        #non zero exit code so torchrun tears the job down
+                        torch.distributed.destroy_process_group()
+                        sys.exit(1)
                     sys.exit()
 
-
-                isdir = os.path.isdir(output_dir)
-                if not isdir:
-                    os.mkdir(output_dir)
+                if self.rank == 0:
+                    isdir = os.path.isdir(output_dir)
+                    if not isdir:
+                        os.mkdir(output_dir)
 
                 from .tools import Logger
-                self.logger = Logger(log_file)
+                self.logger = Logger(log_file, enabled=(self.rank == 0))
 
 
                 now = datetime.now()
@@ -420,6 +486,11 @@ class NuclearReactionPinn:
                 self.logger.write(f"DEBUG_MODE {DEBUG_MODE}")
                 self.logger.write(f"DO_PLOTTING {DO_PLOTTING}")
                 self.logger.write(f"DO_HYPER_OPTIMIZATION {DO_HYPER_OPTIMIZATION}")
+                self.logger.write(f"USE_AMP {self.USE_AMP}")
+                self.logger.write(f"USE_BF16 {self.USE_BF16}")
+                self.logger.write(f"COMPILE_MODEL {COMPILE_MODEL}")
+                self.logger.write(f"batch_size {batch_size}")
+                self.logger.write(f"world_size {self.world_size}")
 
 
                 plotfiles = glob(data_path + plotfile_prefix)
@@ -431,20 +502,25 @@ class NuclearReactionPinn:
                 react_data = ReactDataset(data_path, input_prefix, output_prefix, plotfile_prefix, DEBUG_MODE=DEBUG_MODE)
                 self.nnuc = int(react_data.output_data.shape[1]/2 - 1)
 
-                #Normalize density, temperature, and enuc
-                dens_fac = torch.max(react_data.input_data[:, self.nnuc+1, :])
-                temp_fac = torch.max(react_data.input_data[:, self.nnuc+2, :])
-                enuc_fac = torch.max(react_data.output_data[:, self.nnuc, :])
-                enuc_dot_fac = torch.max(react_data.output_data[:, 2*(self.nnuc+1) - 1, :])
+                #Samples on the host in a component major (structure of arrays) layout, each
+                #field is one contiguous row of length N.
+                input_samples, output_samples = react_data.samples(dtype=torch.float64)
+
+                #Normalize density, temperature, and enuc. Density and temperature
+                #are neighbouring rows so they share one reduction, then the
+                #data is scaled in place by the reciprocal of the factors.
+                in_facs = input_samples[self.nnuc+1:self.nnuc+3].amax(dim=1, keepdim=True)
+                dens_fac, temp_fac = in_facs.flatten()
+                enuc_fac = torch.max(output_samples[self.nnuc])
+                enuc_dot_fac = torch.max(output_samples[2*(self.nnuc+1) - 1])
 
 
                 #RHS temperature at tn+1 (obtained from calling EOS)
                 #rhs_fac = torch.max(react_data.output_data[:, 14, :])
 
-                react_data.input_data[:, self.nnuc+1, :]  = react_data.input_data[:, self.nnuc+1, :]/dens_fac
-                react_data.input_data[:, self.nnuc+2, :]  = react_data.input_data[:, self.nnuc+2, :]/temp_fac
-                react_data.output_data[:, self.nnuc, :] = react_data.output_data[:, self.nnuc, :]/enuc_fac
-                react_data.output_data[:, 2*(self.nnuc+1) - 1, :] = react_data.output_data[:, 2*(self.nnuc+1) - 1, :]/enuc_dot_fac
+                input_samples[self.nnuc+1:self.nnuc+3].mul_(in_facs.reciprocal())
+                output_samples[self.nnuc].mul_(1/enuc_fac)
+                output_samples[2*(self.nnuc+1) - 1].mul_(1/enuc_dot_fac)
 
                 #dpndx[enuc] = enuc_fac/enuc_dot_fac * dpndx[enuc]
 
@@ -455,14 +531,26 @@ class NuclearReactionPinn:
                 Num_test  = int(N*percent_test/100)
                 Num_train = N-Num_test
 
-                train_set, test_set = torch.utils.data.random_split(react_data, [Num_train, Num_test])
-
-                self.train_loader = DataLoader(dataset=train_set, batch_size=16, shuffle=True)
-                self.test_loader = DataLoader(dataset=test_set, batch_size=16, shuffle=True)
+                #The whole data set fits on the device, so it is uploaded once and
+                #batches are gathered there instead of collated by a DataLoader.
+                #It is uploaded sample major ([N, fields]) so gathering a batch
+                #reads one contiguous row per sample.
+                input_samples = input_samples.t().to(device=device, dtype=torch.float).contiguous()
+                output_samples = output_samples.t().to(device=device, dtype=torch.float).contiguous()
+                perm = torch.randperm(N, device=device)
+                if self.distributed:
+                    #every rank needs the same train/test split
+                    torch.distributed.broadcast(perm, 0)
+                    #equal sized shards so every rank runs the same number of batches
+                    shard = Num_train // self.world_size
+                    train_idx = perm[self.rank*shard:(self.rank+1)*shard]
+                else:
+                    train_idx = perm[:Num_train]
+                self.train_loader = DeviceBatchLoader(input_samples, output_samples, train_idx, batch_size=batch_size)
+                self.test_loader = DeviceBatchLoader(input_samples, output_samples, perm[Num_train:], batch_size=batch_size)
 
-                self.fields = [field for field in yt.load(react_data.output_files[0])._field_list]
-                input_fields = [field for field in yt.load(react_data.input_files[0])._field_list]
-                self.input_fields = ['dt'] + input_fields
+                self.fields = react_data.fields
+                self.input_fields = ['dt'] + react_data.input_fields
 
 
 # if DO_HYPER_OPTIMIZATION:
@@ -510,12 +598,20 @@ class NuclearReactionPinn:
 
 
 
-    def train(self, model, optimizer, num_epochs, criterion, save_every_N=np.Inf):
+    def train(self, model, optimizer, num_epochs, criterion, save_every_N=np.Inf, test_every_N=5):
         '''
         save_every_N - int representing every N epochs output the pytorch model.
                      Defaulted at infinity, meaning it won't output intermediately
+
+        test_every_N - int representing every N epochs evaluate the testing data
+                     for the plots (only if DO_PLOTTING). The last epoch is
+                     always evaluated. Defaulted at 5
         '''
 
+        #only rank 0 writes output
+        if self.rank != 0:
+            save_every_N = np.Inf
+
         if save_every_N < np.Inf:
             os.mkdir(self.output_dir+'intermediate_output/')
 
@@ -533,6 +629,7 @@ class NuclearReactionPinn:
         self.d_component_losses_test = [] #stores derivative component wise loss at each epoch (test data)
         self.d_component_losses_train = [] #stores derivative component wise loss at each epoch (train data)
         self.cost_per_epoc_test = []
+        self.test_epochs = [] #epochs at which the test data was evaluated
         self.different_loss_metrics = [] #list of arrays of the various loss metrics defined in criterion
 
         if self.DO_GRADIENT_PLOT:
@@ -543,9 +640,10 @@ class NuclearReactionPinn:
                     data_whole = data
                 else:
                     data_whole = torch.cat((data_whole, data))
+            data_whole = data_whole.cpu()
             N = data_whole.shape[0]
             for i in range(data_whole.shape[1]):
-                plt.scatter([i]*N, data_whole[:, i], label=input_fields[i])
+                plt.scatter([i]*N, data_whole[:, i], label=self.input_fields[i])
             plt.yscale("log")
             plt.legend()
             plt.savefig(self.output_dir + "input_fig.png",bbox_inches='tight')
@@ -558,144 +656,147 @@ class NuclearReactionPinn:
 
 
 
+        if self.COMPILE_MODEL:
+            #The dt derivative is a double backward through the network, which
+            #torch.compile does not support, so TorchScript is used instead.
+            model = torch.jit.script(model)
+
+        #net is the bare model, used for evaluation and saving. Evaluating
+        #through the DDP wrapper would make it wait for a backward pass.
+        net = model
+        if self.distributed:
+            model = nn.parallel.DistributedDataParallel(model, device_ids=[self.local_rank])
+
+        #loss scaling keeps float16 gradients from underflowing. bfloat16 does
+        #not need it. When disabled this is a pass through.
+        scaler = torch.cuda.amp.GradScaler(enabled=self.USE_AMP and not self.USE_BF16)
+        autocast_args = {'dtype': torch.bfloat16} if self.USE_BF16 else {}
+
         labels = []
         xs = []
         #train network
         for epoch in range(num_epochs):
-            losses = []
-            plotting_losses = []
-            diff_losses = []
+            #running sums stay on the device so there is only one sync per epoch
+            losses_sum = torch.zeros(1, device=device)
+            plotting_losses_sum = torch.zeros(1, device=device)
+            component_loss = torch.zeros(self.nnuc+1, device=device)
+            d_component_loss = torch.zeros(self.nnuc+1, device=device)
+            diff_losses_sum = 0
 
             for batch_idx, (data, targets) in enumerate(self.train_loader):
-                # Get data to cuda if possible
-                data = data.to(device=device)
+                # batches are already on the device
                 data.requires_grad=True
 
-                targets = targets.to(device=device)
-
-                # forward
-                prediction = model(data)
-
-                # calculate derivatives
-                dXdt = torch.zeros_like(prediction)
-                for n in range(self.nnuc+1):
-                    if data.grad is not None:
-                        #sets componnents to zero if not already zero
-                        data.grad.data.zero_()
+                with torch.cuda.amp.autocast(enabled=self.USE_AMP, **autocast_args):
+                    # forward
+                    prediction = model(data)
 
-                    prediction[:, n].backward(torch.ones_like(prediction[:,n]), retain_graph=True)
-                    dXdt[:, n] = data.grad.clone()[:, 0]
-                    data.grad.data.zero_()
+                    # calculate derivatives. The graph is kept so that the pinn
+                    # terms of the loss also train the network.
+                    dXdt = time_derivative(prediction, data, create_graph=True)
 
-                dXdt.requires_grad = True
-                loss, array_loss = criterion(data, prediction, dXdt, targets)
+                    loss, array_loss = criterion(data, prediction, dXdt, targets)
 
-                losses.append(loss.item())
-                diff_losses.append(array_loss)
+                losses_sum += loss.detach()
+                #criterions should return their loss terms as a detached tensor so
+                #this stays on the device. A list of floats still works.
+                if not torch.is_tensor(array_loss):
+                    array_loss = torch.tensor(array_loss, device=device)
+                diff_losses_sum = diff_losses_sum + array_loss.detach()
 
                 # backward
-                optimizer.zero_grad()
-                loss.backward()
+                optimizer.zero_grad(set_to_none=True)
+                scaler.scale(loss).backward()
 
                 #only do gradient plot for batch 0
                 if self.DO_GRADIENT_PLOT:
+                    #plot the true gradients, not the scaled ones
+                    scaler.unscale_(optimizer)
                     with torch.no_grad():
                         if batch_idx == 0:
-                            for i, (name, param) in enumerate(model.named_parameters()):
+                            for i, (name, param) in enumerate(net.named_parameters()):
                                 if epoch == 0:
                                     xs.append(i)
                                     labels.append(name)
                                 if epoch % stride == 0:
                                     N=len(param.grad.flatten())
                                     if i==0:
-                                        ax_grad[0].scatter([i]*N, np.abs(param.grad.flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride, label=f'epoch {epoch}')
-                                        ax_grad[1].scatter([i]*N, np.abs(param.detach().numpy().flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride, label=f'epoch {epoch}')
+                                        ax_grad[0].scatter([i]*N, np.abs(param.grad.flatten().cpu().numpy()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride, label=f'epoch {epoch}')
+                                        ax_grad[1].scatter([i]*N, np.abs(param.detach().cpu().numpy().flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride, label=f'epoch {epoch}')
                                     else:
-                                        ax_grad[0].scatter([i]*N, np.abs(param.grad.flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride)
-                                        ax_grad[1].scatter([i]*N, np.abs(param.detach().numpy().flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride)
+                                        ax_grad[0].scatter([i]*N, np.abs(param.grad.flatten().cpu().numpy()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride)
+                                        ax_grad[1].scatter([i]*N, np.abs(param.detach().cpu().numpy().flatten()), color =cmap[epoch//stride], s=2*num_epochs//stride-2*epoch//stride)
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
 
                 #PLOTTING TERMS
-                loss_plot = criterion_plotting(prediction, targets)
-                plotting_losses.append(loss_plot.item())
+                with torch.no_grad():
+                    #plotting metrics are always computed in full precision
+                    prediction = prediction.float()
+                    dXdt = dXdt.float()
 
-                loss_c = component_loss_f(prediction, targets[:, :self.nnuc+1])
-                loss_c = np.array(loss_c.tolist())
+                    plotting_losses_sum += criterion_plotting(prediction, targets)
 
-                #L1 loss bc big errors at first squaring big numbers results in nans
-                dloss_c = component_loss_f_L1(dXdt, targets[:, self.nnuc+1:])
-                dloss_c = np.array(dloss_c.tolist())
+                    component_loss += component_loss_f(prediction, targets[:, :self.nnuc+1])
 
-                if batch_idx == 0:
-                    component_loss = loss_c
-                    d_component_loss = dloss_c
+                    #L1 loss bc big errors at first squaring big numbers results in nans
+                    d_component_loss += component_loss_f_L1(dXdt, targets[:, self.nnuc+1:])
 
-                else:
-                    component_loss = component_loss + loss_c
-                    d_component_loss = d_component_loss + dloss_c
+            num_batches = batch_idx + 1
 
+            if self.distributed:
+                #average the epoch sums over the ranks, once per epoch
+                for metric_sum in [losses_sum, plotting_losses_sum, component_loss,
+                                   d_component_loss, diff_losses_sum]:
+                    torch.distributed.all_reduce(metric_sum)
+                    metric_sum /= self.world_size
 
-            self.logger.write(f"Cost at epoch {epoch} is {sum(losses) / len(losses)}")
+            self.logger.write(f"Cost at epoch {epoch} is {losses_sum.item() / num_batches}")
+            #so an interrupted run still has its log
+            self.logger.flush()
             #Cost per epoc
-            self.cost_per_epoc.append(sum(plotting_losses) / len(plotting_losses))
+            self.cost_per_epoc.append(plotting_losses_sum.item() / num_batches)
 
-            #cost_per_epoc.append(sum(losses) / len(losses))
-            self.component_losses_train.append(component_loss/batch_idx)
-            self.d_component_losses_train.append(d_component_loss/batch_idx)
+            self.component_losses_train.append((component_loss/num_batches).cpu().numpy())
+            self.d_component_losses_train.append((d_component_loss/num_batches).cpu().numpy())
 
-            diff_losses = np.array(diff_losses)
-            self.different_loss_metrics.append(diff_losses.sum(axis=0)/len(losses))
+            self.different_loss_metrics.append((diff_losses_sum/num_batches).cpu().numpy())
 
 
 
-            if self.DO_PLOTTING:
-                model.eval()
+            if self.DO_PLOTTING and (epoch % test_every_N == 0 or epoch == num_epochs-1):
+                net.eval()
 
-                for batch_idx, (data, targets) in enumerate(self.train_loader):
-                    # Get data to cuda if possible
-                    data = data.to(device=device)
-                    targets = targets.to(device=device)
+                losses_sum = torch.zeros(1, device=device)
+                component_loss = torch.zeros(self.nnuc+1, device=device)
+                d_component_loss = torch.zeros(self.nnuc+1, device=device)
 
-                    # forward
+                for batch_idx, (data, targets) in enumerate(self.test_loader):
+                    # forward and derivatives need autograd, the metrics do not
                     data.requires_grad=True
 
-                    prediction = model(data)
-                    loss = criterion_plotting(prediction, targets)
-                    losses.append(loss.item())
+                    prediction = net(data)
 
                     # calculate derivatives
-                    dXdt = torch.zeros_like(prediction)
-                    for n in range(self.nnuc+1):
-                        if data.grad is not None:
-                            #sets componnents to zero if not already zero
-                            data.grad.data.zero_()
-
-                        prediction[:, n].backward(torch.ones_like(prediction[:,n]), retain_graph=True)
-                        dXdt[:, n] = data.grad.clone()[:, 0]
-                        data.grad.data.zero_()
+                    dXdt = time_derivative(prediction, data)
 
+                    with torch.inference_mode():
+                        losses_sum += criterion_plotting(prediction, targets)
 
-                    # -- Component and Deritivave component loss
-                    loss_c = component_loss_f(prediction, targets[:, :self.nnuc+1])
-                    loss_c = np.array(loss_c.tolist())
+                        # -- Component and Deritivave component loss
+                        component_loss += component_loss_f(prediction, targets[:, :self.nnuc+1])
 
-                    #L1 loss bc big errors at first squaring big numbers results in nans
-                    dloss_c = component_loss_f_L1(dXdt, targets[:, self.nnuc+1:])
-                    dloss_c = np.array(dloss_c.tolist())
-
-                    if batch_idx == 0:
-                        component_loss = loss_c
-                        d_component_loss = dloss_c
-                    else:
-                        component_loss = component_loss + loss_c
-                        d_component_loss = d_component_loss + dloss_c
+                        #L1 loss bc big errors at first squaring big numbers results in nans
+                        d_component_loss += component_loss_f_L1(dXdt, targets[:, self.nnuc+1:])
 
-                model.train()
+                net.train()
 
-                self.cost_per_epoc_test.append(sum(losses) / len(losses))
-                self.component_losses_test.append(component_loss/batch_idx)
-                self.d_component_losses_test.append(d_component_loss/batch_idx)
+                num_batches = batch_idx + 1
+                self.test_epochs.append(epoch)
+                self.cost_per_epoc_test.append(losses_sum.item() / num_batches)
+                self.component_losses_test.append((component_loss/num_batches).cpu().numpy())
+                self.d_component_losses_test.append((d_component_loss/num_batches).cpu().numpy())
 
             with torch.no_grad():
                 if epoch % save_every_N == 0 and epoch != 0:
@@ -703,19 +804,21 @@ class NuclearReactionPinn:
                     os.mkdir(directory)
 
 
-                    torch.save(model.state_dict(), directory+'my_model.pt')
-                    np.savetxt(directory + "/cost_per_epoch.txt", self.cost_per_epoc)
-                    np.savetxt(directory + "/component_losses_test.txt", self.component_losses_test)
-                    np.savetxt(directory + "/component_losses_train.txt", self.component_losses_train)
-                    np.savetxt(self.output_dir + "/d_component_losses_test.txt", self.d_component_losses_test)
-                    np.savetxt(self.output_dir + "/d_component_losses_train.txt", self.d_component_losses_train)
+                    #binary .npy checkpoints, text is only written once at the end
+                    save_model(net, directory+'my_model.pt')
+                    np.save(directory + "/cost_per_epoch.npy", self.cost_per_epoc)
+                    np.save(directory + "/component_losses_test.npy", self.component_losses_test)
+                    np.save(directory + "/component_losses_train.npy", self.component_losses_train)
+                    np.save(directory + "/d_component_losses_test.npy", self.d_component_losses_test)
+                    np.save(directory + "/d_component_losses_train.npy", self.d_component_losses_train)
+                    np.save(directory + "/test_epochs.npy", self.test_epochs)
 
 
-                    plot_class = plotting_pinn(self.model, self.fields, self.test_loader, self.cost_per_epoc,
+                    plot_class = plotting_pinn(net, self.fields, self.test_loader, self.cost_per_epoc,
                                 np.array(self.component_losses_test), np.array(self.component_losses_train),
                                 np.array(self.d_component_losses_test), np.array(self.d_component_losses_train),
                                 self.cost_per_epoc_test, np.array(self.different_loss_metrics),
-                                self.output_dir)
+                                self.output_dir, test_epochs=self.test_epochs)
 
                     plot_class.do_all_plots()
 
@@ -729,17 +832,13 @@ class NuclearReactionPinn:
 
         if self.SAVE_MODEL:
             self.logger.write("Saving...")
-            file_name = self.output_dir + 'my_model_pinn.pt'
-            if os.path.exists(file_name):
-                self.logger.write("Overwritting file:", file_name)
-                os.rename(file_name, file_name+'.backup')
-
-            torch.save(model.state_dict(), file_name)
+            save_model(net, self.output_dir + 'my_model_pinn.pt')
             np.savetxt(self.output_dir + "/cost_per_epoch.txt", self.cost_per_epoc)
             np.savetxt(self.output_dir + "/component_losses_test.txt", self.component_losses_test)
             np.savetxt(self.output_dir + "/component_losses_train.txt", self.component_losses_train)
             np.savetxt(self.output_dir + "/d_component_losses_test.txt", self.d_component_losses_test)
             np.savetxt(self.output_dir + "/d_component_losses_train.txt", self.d_component_losses_train)
+            np.savetxt(self.output_dir + "/test_epochs.txt", self.test_epochs, fmt='%d')
 
 
 
@@ -756,17 +855,25 @@ class NuclearReactionPinn:
                 ax_grad[1].set_title("NN parameters")
                 fig.savefig(self.output_dir + "gradient_plot.pdf", bbox_inches='tight')
 
-        self.model = model
+        self.model = net
+
+        if self.distributed:
+            #the ranks don't communicate after training
+            torch.distributed.destroy_process_group()
 
 
     def plot(self):
 
+        #only rank 0 has the test metrics
+        if self.rank != 0:
+            return
+
         self.logger.write("Plotting...")
 
         plot_class = plotting_pinn(self.model, self.fields, self.test_loader, self.cost_per_epoc,
                     self.component_losses_test, self.component_losses_train,
                     self.d_component_losses_test, self.d_component_losses_train,
                     self.cost_per_epoc_test, self.different_loss_metrics,
-                    self.output_dir)
+                    self.output_dir, test_epochs=self.test_epochs)
 
         plot_class.do_all_plots()